@@ -1,9 +1,16 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
+from fastapi import APIRouter, UploadFile, File, HTTPException, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from app.schemas.api_models import SessionInitResponse, TextAnalysisRequest, InteractionRequest, AnalysisResponse
+from app.schemas.api_models import SequenceInitResponse, SequenceAnalysisRequest
+from app.services.sequence_engine import SequenceSession
+from typing import List
+import json
 from app.core.state import global_state
 from app.core.memory import SessionMemory, TaskStep
+from app.core.cache import hash_bytes
+import asyncio
 import uuid
-import shutil
 import os
 
 router = APIRouter()
@@ -14,20 +21,35 @@ MASK_DIR = "static/masks"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(MASK_DIR, exist_ok=True)
 
+async def _save_upload(file: UploadFile, session_id: str):
+    """按内容哈希命名：相同图片只落盘一次，并作为跨会话缓存键。返回 (image_hash, file_path, safe_filename)"""
+    try:
+        data = await file.read()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"文件读取失败: {e}")
+    image_hash = hash_bytes(data)
+
+    file_extension = os.path.splitext(file.filename)[1]
+    safe_filename = f"{image_hash}{file_extension}"
+    file_path = os.path.join(UPLOAD_DIR, safe_filename)
+
+    if os.path.exists(file_path):
+        print(f"[Init] Duplicate upload, reusing {safe_filename}")
+    else:
+        try:
+            tmp_path = f"{file_path}.{session_id}.tmp"
+            with open(tmp_path, "wb") as buffer:
+                buffer.write(data)
+            os.replace(tmp_path, file_path)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"文件保存失败: {e}")
+    return image_hash, file_path, safe_filename
+
 @router.post("/session/init", response_model=SessionInitResponse)
 async def init_session(file: UploadFile = File(...)):
     """初始化会话，保存图片，预热 SAM"""
     session_id = str(uuid.uuid4())
-    
-    file_extension = os.path.splitext(file.filename)[1]
-    safe_filename = f"{session_id}{file_extension}"
-    file_path = os.path.join(UPLOAD_DIR, safe_filename)
-
-    try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"文件保存失败: {e}")
+    image_hash, file_path, safe_filename = await _save_upload(file, session_id)
 
     # === 【关键修改开始】 ===
     # 获取文件的绝对路径。这能解决 WSL/Docker 环境下 Agent 找不到文件的问题。
@@ -35,13 +57,24 @@ async def init_session(file: UploadFile = File(...)):
     print(f"[Init] Image saved to absolute path: {abs_file_path}")
 
     # 初始化记忆 (存储绝对路径)
-    new_session = SessionMemory(session_id=session_id, image_path=abs_file_path)
+    new_session = SessionMemory(session_id=session_id, image_path=abs_file_path, image_hash=image_hash)
     global_state.sessions[session_id] = new_session
 
+    # 解码一次存入 ImageStore (后续 SAM/VLM 共享内存映射)，后台构建瓦片金字塔
+    image_dims, tile_url = [0, 0], None
+    try:
+        height, width = global_state.image_store.ingest(image_hash, abs_file_path)
+        image_dims = [width, height]
+        tile_url = f"/api/v1/tiles/{image_hash}.dzi"
+    except Exception as e:
+        print(f"图像解码警告: {e}")
+
     # 预热 SAM (使用绝对路径)
     try:
         print(f"正在为会话 {session_id} 预计算 SAM 特征...")
-        global_state.sam_engine.set_image(session_id, abs_file_path)
+        await asyncio.wrap_future(global_state.sam_scheduler.submit_call(
+            global_state.sam_engine.set_image, session_id, abs_file_path, image_hash=image_hash
+        ))
     except Exception as e:
         print(f"SAM 预热警告: {e}")
     # === 【关键修改结束】 ===
@@ -49,9 +82,55 @@ async def init_session(file: UploadFile = File(...)):
     return {
         "session_id": session_id,
         "image_url": f"/static/uploads/{safe_filename}", 
-        "image_dims": [1024, 1024]
+        "image_dims": image_dims,
+        "tile_url": tile_url
     }
 
+@router.post("/sequence/init", response_model=SequenceInitResponse)
+async def init_sequence(files: List[UploadFile] = File(...)):
+    """初始化图像序列会话 (原位加热/变形等同一视场的连续帧)，按上传顺序作为帧序"""
+    if not files:
+        raise HTTPException(status_code=400, detail="未提供序列帧。")
+
+    session_id = str(uuid.uuid4())
+    frame_paths, frame_hashes = [], []
+    for file in files:
+        image_hash, file_path, _ = await _save_upload(file, session_id)
+        frame_paths.append(os.path.abspath(file_path))
+        frame_hashes.append(image_hash)
+
+    def ingest_frames():
+        for image_hash, abs_file_path in zip(frame_hashes, frame_paths):
+            try:
+                global_state.image_store.ingest(image_hash, abs_file_path, build_tiles=False)
+            except Exception as e:
+                print(f"图像解码警告: {e}")
+
+    # 数百帧的解码与落盘放到线程池，不阻塞事件循环；序列帧不提供瓦片，不构建金字塔
+    await run_in_threadpool(ingest_frames)
+
+    global_state.sequences[session_id] = SequenceSession(session_id, frame_paths, frame_hashes)
+    print(f"[Sequence] Session {session_id} with {len(frame_paths)} frames.")
+    return {"session_id": session_id, "frame_count": len(frame_paths)}
+
+@router.post("/sequence/analyze")
+def analyze_sequence(request: SequenceAnalysisRequest):
+    """
+    首帧文本分割 + 逐帧 mask 传播，按帧流式返回相分数时间序列 (NDJSON，每行一帧)。
+    不经过 LLM 规划循环。
+    """
+    sequence = global_state.sequences.get(request.session_id)
+    if sequence is None:
+        raise HTTPException(status_code=404, detail="序列会话不存在。")
+    if not request.prompts:
+        raise HTTPException(status_code=400, detail="未提供分割提示词。")
+
+    def stream():
+        for record in global_state.sequence_engine.analyze(sequence, request.prompts):
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
 @router.post("/analyze/text", response_model=AnalysisResponse)
 async def analyze_text(request: TextAnalysisRequest):
     session_id = request.session_id
@@ -107,7 +186,19 @@ async def analyze_text(request: TextAnalysisRequest):
             prompts = params.get("prompts", [])
             print(f"--> Executing SAM 3 with prompts: {prompts}")
             
-            sam_result = global_state.sam_engine.predict_by_text(session_id, prompts)
+            sam_result = global_state.tool_cache.lookup(session_memory.image_hash, "sam3", params)
+            if sam_result is not None:
+                print("    SAM 3 result served from cache.")
+            else:
+                # 未找到 / mask 不合理时在同一次调度调用中做本地同义词恢复 (逐个失败的 prompt)，避免 VLM + LLM 往返
+                sam_result = await asyncio.wrap_future(global_state.sam_scheduler.submit_call(
+                    global_state.sam_engine.predict_with_recovery, session_id, prompts
+                ))
+                if sam_result.get("recovered"):
+                    print(f"    Recovered prompts: {sam_result['recovered_from']}")
+
+                if sam_result["success"]:
+                    global_state.tool_cache.store(session_memory.image_hash, "sam3", params, sam_result)
             
             status = "success" if sam_result["success"] and sam_result.get("found") else "failed"
             session_memory.update_task_result(
@@ -128,13 +219,22 @@ async def analyze_text(request: TextAnalysisRequest):
             # 使用记忆中的绝对路径
             current_abs_path = session_memory.image_path
             
-            if not current_abs_path or not os.path.exists(current_abs_path):
+            vlm_res = global_state.tool_cache.lookup(session_memory.image_hash, "vlm", params)
+            if vlm_res is not None:
+                print("    VLM result served from cache.")
+            elif not current_abs_path or not os.path.exists(current_abs_path):
                 vlm_res = {"success": False, "message": f"Image file not found at: {current_abs_path}"}
             else:
+                image = None
+                if global_state.image_store.has(session_memory.image_hash):
+                    image = global_state.image_store.get(session_memory.image_hash)
                 vlm_res = global_state.llm_agent.vlm_agent.answer_visual_question(
                     current_abs_path, 
-                    query
+                    query,
+                    image=image
                 )
+                if vlm_res["success"]:
+                    global_state.tool_cache.store(session_memory.image_hash, "vlm", params, vlm_res)
             
             print(f"    VLM Result: {vlm_res.get('answer', 'No answer')[:50]}...")
             
@@ -176,4 +276,66 @@ async def interact(request: InteractionRequest):
         message="分割结果已根据您的点击更新。",
         mask_url=result['mask_url'],
         stats=result['stats']
-    )
\ No newline at end of file
+    )
+
+@router.get("/metrics/sam")
+async def sam_metrics():
+    """SAM 调度器指标：实际批大小、排队延迟等"""
+    return global_state.sam_scheduler.metrics()
+
+@router.get("/masks/{filename}")
+async def get_mask(filename: str):
+    """返回 mask 文件；若后台仍在编码则等待其写完"""
+    filename = os.path.basename(filename)
+    future = global_state.sam_engine.mask_writer.future(filename)
+    if future is not None:
+        try:
+            await asyncio.wrap_future(future)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Mask 编码失败: {e}")
+
+    path = os.path.join(MASK_DIR, filename)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Mask 不存在。")
+    return FileResponse(path, media_type="image/png")
+
+# 瓦片按内容寻址 (原图) 或随 mask 重写而变化，统一用 ETag 协商缓存
+TILE_CACHE_CONTROL = "public, max-age=3600"
+
+async def _serve_tile_file(request: Request, image_id: str, path: str, media_type: str):
+    # 依次等待：mask PNG 写完 / 金字塔就绪 (首次请求时从原图数组或 mask PNG 按需构建)
+    mask_writer = global_state.sam_engine.mask_writer
+    mask_path = os.path.join(mask_writer.mask_dir, f"{image_id}.png")
+    for get_future in (lambda: mask_writer.future(f"{image_id}.png"),
+                       lambda: global_state.image_store.ensure_pyramid(image_id, mask_path)):
+        future = get_future()
+        if future is None:
+            continue
+        try:
+            await asyncio.wrap_future(future)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"瓦片生成失败: {e}")
+
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="瓦片不存在。")
+
+    stat = os.stat(path)
+    etag = f'"{int(stat.st_mtime_ns):x}-{stat.st_size:x}"'
+    headers = {"ETag": etag, "Cache-Control": TILE_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+@router.get("/tiles/{image_id}.dzi")
+async def get_tile_descriptor(request: Request, image_id: str):
+    """DZI 描述文件 (原图为图像哈希，mask 叠加层为 mask 文件名去掉 .png)"""
+    image_id = os.path.basename(image_id)
+    path = os.path.join(global_state.image_store.tile_dir, f"{image_id}.dzi")
+    return await _serve_tile_file(request, image_id, path, "application/xml")
+
+@router.get("/tiles/{image_id}_files/{level}/{tile}")
+async def get_tile(request: Request, image_id: str, level: int, tile: str):
+    """单张瓦片: {col}_{row}.png"""
+    image_id, tile = os.path.basename(image_id), os.path.basename(tile)
+    path = os.path.join(global_state.image_store.tile_dir, f"{image_id}_files", str(level), tile)
+    return await _serve_tile_file(request, image_id, path, "image/png")
\ No newline at end of file
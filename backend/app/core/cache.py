@@ -0,0 +1,79 @@
+import hashlib
+import json
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Hashable, Optional
+
+
+def hash_bytes(data: bytes) -> str:
+    """图像内容哈希 (sha256)，用作跨会话的去重/缓存键"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def normalize_params(tool: str, params: Dict[str, Any]) -> str:
+    """
+    规范化工具参数，使语义相同的调用得到相同的键。
+    - sam3: prompts 去空白、小写、去重并排序 (合并 mask 与顺序无关)
+    - 其他: 字符串去首尾空白
+    """
+    params = dict(params or {})
+    if tool == "sam3":
+        prompts = params.get("prompts", [])
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        params["prompts"] = sorted({p.strip().lower() for p in prompts if p and p.strip()})
+    else:
+        params = {k: v.strip() if isinstance(v, str) else v for k, v in params.items()}
+    return json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+
+
+class LRUCache:
+    """线程安全的有界 LRU 缓存，超出容量时淘汰最久未使用的条目"""
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """只查询是否在缓存中，不计入命中率也不调整顺序"""
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class ToolResultCache(LRUCache):
+    """按 (图像哈希, 工具, 规范化参数) 记忆工具结果，跨会话共享"""
+
+    @staticmethod
+    def make_key(image_hash: Optional[str], tool: str, params: Dict[str, Any]):
+        return (image_hash, tool, normalize_params(tool, params))
+
+    def lookup(self, image_hash: Optional[str], tool: str, params: Dict[str, Any]) -> Optional[Any]:
+        if not image_hash:
+            return None
+        return self.get(self.make_key(image_hash, tool, params))
+
+    def store(self, image_hash: Optional[str], tool: str, params: Dict[str, Any], result: Any):
+        if not image_hash:
+            return
+        self.put(self.make_key(image_hash, tool, params), result)
@@ -0,0 +1,206 @@
+import os
+import math
+import shutil
+import uuid
+import cv2
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, Optional, Tuple
+from app.core.cache import LRUCache
+
+ARRAY_DIR = "data/arrays"
+TILE_DIR = "data/tiles"
+TILE_SIZE = 256
+
+DZI_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="png" Overlap="0" TileSize="{tile_size}">'
+    '<Size Width="{width}" Height="{height}"/></Image>\n'
+)
+
+
+def build_pyramid(image_id: str, image: np.ndarray, tile_dir: str = TILE_DIR, tile_size: int = TILE_SIZE):
+    """
+    生成 DZI 风格的多分辨率瓦片金字塔:
+    {tile_dir}/{image_id}_files/{level}/{col}_{row}.png，最后写 {image_id}.dzi (存在即代表完整)。
+    image: RGB (H, W, 3) 或单通道 (H, W)。
+    """
+    h, w = image.shape[:2]
+    max_level = int(math.ceil(math.log2(max(w, h, 1))))
+    files_dir = os.path.join(tile_dir, f"{image_id}_files")
+
+    # 从最高分辨率逐级缩小，每级只依赖上一级 (避免每级都从原图缩放)
+    level_img = image if image.ndim == 2 else cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR)
+    for level in range(max_level, -1, -1):
+        scale = 2 ** (max_level - level)
+        lw, lh = max(1, math.ceil(w / scale)), max(1, math.ceil(h / scale))
+        if level_img.shape[1] != lw or level_img.shape[0] != lh:
+            level_img = cv2.resize(level_img, (lw, lh), interpolation=cv2.INTER_AREA)
+
+        level_dir = os.path.join(files_dir, str(level))
+        os.makedirs(level_dir, exist_ok=True)
+        for row in range(math.ceil(lh / tile_size)):
+            for col in range(math.ceil(lw / tile_size)):
+                tile = level_img[row * tile_size:(row + 1) * tile_size, col * tile_size:(col + 1) * tile_size]
+                cv2.imwrite(os.path.join(level_dir, f"{col}_{row}.png"), tile)
+
+    dzi_path = os.path.join(tile_dir, f"{image_id}.dzi")
+    with open(dzi_path + ".tmp", "w") as f:
+        f.write(DZI_TEMPLATE.format(tile_size=tile_size, width=w, height=h))
+    os.replace(dzi_path + ".tmp", dzi_path)
+
+
+class ImageStore:
+    """
+    解码一次的图像存储：上传时解码为 RGB 并保存为 .npy，之后各环节 (SAM、VLM、序列分析)
+    通过 np.load(mmap_mode='r') 共享同一份只读内存映射，不再重复解码原文件。
+    瓦片金字塔供 /tiles 接口按需加载：会话原图在上传时后台构建，mask 叠加层与被淘汰的金字塔在首次请求时构建。
+    磁盘上的 .npy 与金字塔数量有上限，超出时按修改时间淘汰最旧的 (正在使用的映射与构建中的金字塔除外)。
+    """
+    def __init__(self, array_dir: str = ARRAY_DIR, tile_dir: str = TILE_DIR, max_workers: int = 1,
+                 max_open_arrays: int = int(os.environ.get("IMAGE_STORE_MAX_OPEN", 64)),
+                 max_arrays: int = int(os.environ.get("IMAGE_STORE_MAX_ARRAYS", 1024)),
+                 max_pyramids: int = int(os.environ.get("IMAGE_STORE_MAX_PYRAMIDS", 256))):
+        self.array_dir = array_dir
+        self.tile_dir = tile_dir
+        self.max_arrays = max_arrays      # 磁盘上最多保留的 .npy 数
+        self.max_pyramids = max_pyramids  # 磁盘上最多保留的金字塔数
+        os.makedirs(self.array_dir, exist_ok=True)
+        os.makedirs(self.tile_dir, exist_ok=True)
+
+        # image_hash -> memmap，有界 LRU (序列帧很多时不会无限持有映射)；被淘汰的映射在无引用后自动关闭
+        self._arrays = LRUCache(max_entries=max_open_arrays)
+        self._pending: Dict[str, Future] = {}    # image_id -> 金字塔构建任务
+        self._lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tile-builder")
+
+    def _array_path(self, image_hash: str) -> str:
+        return os.path.join(self.array_dir, f"{image_hash}.npy")
+
+    def _dzi_path(self, image_id: str) -> str:
+        return os.path.join(self.tile_dir, f"{image_id}.dzi")
+
+    def ingest(self, image_hash: str, file_path: str, build_tiles: bool = True) -> Tuple[int, int]:
+        """
+        解码并持久化 (已存在则直接复用)。返回 (H, W)
+        build_tiles: 是否立即在后台构建金字塔 (序列帧不提供瓦片，传 False)。
+        """
+        array_path = self._array_path(image_hash)
+        if not os.path.exists(array_path):
+            image = cv2.imread(file_path)
+            if image is None: raise FileNotFoundError(f"Image not found: {file_path}")
+            image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            tmp_path = f"{array_path}.{uuid.uuid4().hex}.tmp.npy"
+            np.save(tmp_path, image_rgb)
+            os.replace(tmp_path, array_path)
+
+        image_rgb = self.get(image_hash)
+        self._evict_arrays()
+        if build_tiles and not os.path.exists(self._dzi_path(image_hash)):
+            self.submit_pyramid(image_hash, image_rgb)
+        return image_rgb.shape[:2]
+
+    def has(self, image_hash: Optional[str]) -> bool:
+        return bool(image_hash) and os.path.exists(self._array_path(image_hash))
+
+    def get(self, image_hash: str) -> np.ndarray:
+        """返回只读的 RGB 内存映射 (零拷贝视图)"""
+        array = self._arrays.get(image_hash)
+        if array is None:
+            array = np.load(self._array_path(image_hash), mmap_mode="r")
+            self._arrays.put(image_hash, array)
+        return array
+
+    def submit_pyramid(self, image_id: str, image: np.ndarray) -> Future:
+        return self._submit_build(image_id, lambda: image)
+
+    def ensure_pyramid(self, image_id: str, source_path: Optional[str] = None) -> Optional[Future]:
+        """
+        首次请求瓦片时按需构建金字塔：已存在返回 None；构建中返回其任务；
+        否则从已存储的原图数组，或 source_path 指向的单通道 PNG (mask 叠加层) 构建。无源时返回 None。
+        """
+        if os.path.exists(self._dzi_path(image_id)):
+            return None
+        future = self.future(image_id)
+        if future is not None:
+            return future
+        if self.has(image_id):
+            return self._submit_build(image_id, lambda: self.get(image_id))
+        if source_path and os.path.exists(source_path):
+            return self._submit_build(image_id, lambda: cv2.imread(source_path, cv2.IMREAD_GRAYSCALE))
+        return None
+
+    def _submit_build(self, image_id: str, load: Callable[[], np.ndarray]) -> Future:
+        with self._lock:
+            future = self._pending.get(image_id)
+            if future is not None:
+                return future
+            future = self.executor.submit(self._build, image_id, load)
+            self._pending[image_id] = future
+        future.add_done_callback(lambda f, key=image_id: self._discard(key, f))
+        return future
+
+    def _build(self, image_id: str, load: Callable[[], np.ndarray]):
+        image = load()
+        if image is None:
+            raise FileNotFoundError(f"Image not found: {image_id}")
+        build_pyramid(image_id, image, self.tile_dir)
+        self._evict_pyramids()
+
+    def future(self, image_id: str) -> Optional[Future]:
+        with self._lock:
+            return self._pending.get(image_id)
+
+    def _discard(self, image_id: str, future: Future):
+        with self._lock:
+            if self._pending.get(image_id) is future:
+                del self._pending[image_id]
+
+    # --- 磁盘淘汰 ---
+
+    @staticmethod
+    def _oldest_first(directory: str, suffix: str):
+        """按修改时间从旧到新列出目录下以 suffix 结尾的条目 id"""
+        entries = []
+        for name in os.listdir(directory):
+            if not name.endswith(suffix) or ".tmp" in name:
+                continue
+            try:
+                entries.append((os.path.getmtime(os.path.join(directory, name)), name[:-len(suffix)]))
+            except OSError:
+                continue
+        entries.sort()
+        return [image_id for _, image_id in entries]
+
+    def _evict_arrays(self):
+        """.npy 超出上限时删除最旧的；仍在映射缓存中的跳过 (其会话回退到解码原文件)"""
+        if self.max_arrays <= 0:
+            return
+        image_ids = self._oldest_first(self.array_dir, ".npy")
+        excess = len(image_ids) - self.max_arrays
+        for image_id in image_ids:
+            if excess <= 0:
+                break
+            if image_id in self._arrays:
+                continue
+            try:
+                os.remove(self._array_path(image_id))
+                excess -= 1
+            except OSError:
+                continue
+
+    def _evict_pyramids(self):
+        """金字塔超出上限时删除最旧的；先删 .dzi (标记为不完整)，之后的请求会按需重建"""
+        if self.max_pyramids <= 0:
+            return
+        image_ids = self._oldest_first(self.tile_dir, ".dzi")
+        excess = len(image_ids) - self.max_pyramids
+        for image_id in image_ids[:max(0, excess)]:
+            if self.future(image_id) is not None:
+                continue
+            try:
+                os.remove(self._dzi_path(image_id))
+            except OSError:
+                continue
+            shutil.rmtree(os.path.join(self.tile_dir, f"{image_id}_files"), ignore_errors=True)
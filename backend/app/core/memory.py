@@ -13,9 +13,11 @@ class TaskStep(BaseModel):
     error_msg: Optional[str] = None
 
 class SessionMemory:
-    def __init__(self, session_id: str, image_path: Optional[str] = None):
+    def __init__(self, session_id: str, image_path: Optional[str] = None, image_hash: Optional[str] = None):
         self.session_id = session_id
         self.image_path = image_path
+        # 图像内容哈希，用于跨会话的工具结果缓存
+        self.image_hash = image_hash
         
         # 1. 对话记忆
         self.chat_history: List[Dict[str, str]] = []
@@ -1,21 +1,37 @@
 # backend/app/core/state.py
 
 from app.services.sam_engine import SAMEngine
+from app.services.sam_scheduler import SAMScheduler
 from app.services.llm_agent import LLMAgent
+from app.services.sequence_engine import SequenceEngine, SequenceSession
 # 移除 VLMAgent 的直接引用，因为 LLM 会持有它，或者在这里保留也可以
 # from app.services.vlm_agent import VLMAgent 
 from app.core.memory import SessionMemory # <--- 新增
+from app.core.cache import ToolResultCache
+from app.core.image_store import ImageStore
 from typing import Dict
+import os
 
 class GlobalState:
     def __init__(self):
-        self.sam_engine = SAMEngine()
+        # 解码一次、各环节共享的图像存储
+        self.image_store = ImageStore()
+        self.sam_engine = SAMEngine(image_store=self.image_store)
         self.llm_agent = LLMAgent()
+        # 所有 SAM 推理经由调度器串行执行 (predictor 是有状态的)
+        self.sam_scheduler = SAMScheduler(self.sam_engine)
+        self.sequence_engine = SequenceEngine(self.sam_engine, self.sam_scheduler)
         
         # 替代旧的 image_paths 字典，使用功能更强大的 Memory 字典
         # {session_id: SessionMemory}
         self.sessions: Dict[str, SessionMemory] = {} 
 
+        # 序列 (原位视频) 会话: {session_id: SequenceSession}
+        self.sequences: Dict[str, SequenceSession] = {}
+
+        # 跨会话的工具结果缓存: (image_hash, tool, params) -> result
+        self.tool_cache = ToolResultCache(max_entries=int(os.environ.get("TOOL_CACHE_SIZE", 256)))
+
     def get_session(self, session_id: str) -> SessionMemory:
         if session_id not in self.sessions:
             # 如果不存在，创建一个空的 (通常在 init 接口创建，这里防守性编程)
@@ -8,6 +8,10 @@ class TextAnalysisRequest(BaseModel):
     text_prompt: str
     chat_history: Optional[List[Any]] = None
 
+class SequenceAnalysisRequest(BaseModel):
+    session_id: str
+    prompts: List[str]
+
 class InteractionPoint(BaseModel):
     x: float
     y: float
@@ -24,7 +28,12 @@ class InteractionRequest(BaseModel):
 class SessionInitResponse(BaseModel):
     session_id: str
     image_url: str
-    image_dims: List[int]
+    image_dims: List[int]  # [width, height]
+    tile_url: Optional[str] = None  # DZI 描述文件地址
+
+class SequenceInitResponse(BaseModel):
+    session_id: str
+    frame_count: int
 
 class AnalysisResponse(BaseModel):
     success: bool
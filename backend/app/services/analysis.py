@@ -0,0 +1,79 @@
+import cv2
+import numpy as np
+import torch
+from typing import Any, Dict, Tuple
+
+# mask 合理性阈值：面积占比 (%) 上下限，连通域数量上限 (过碎通常是纹理噪声)
+MIN_VOLUME_FRACTION = 0.05
+MAX_VOLUME_FRACTION = 95.0
+MAX_COMPONENTS = 5000
+
+
+# np.packbits 的位序 (big-endian)：每 8 个像素中第一个对应最高位
+_BIT_WEIGHTS = (128, 64, 32, 16, 8, 4, 2, 1)
+
+
+def _packbits_tensor(mask: torch.Tensor) -> np.ndarray:
+    """在 Tensor 所在设备上按 np.packbits 的格式打包，只把 H*W/8 字节拷回 CPU"""
+    flat = mask.reshape(-1).to(torch.uint8)
+    pad = (-flat.numel()) % 8
+    if pad:
+        flat = torch.cat([flat, flat.new_zeros(pad)])
+    weights = torch.tensor(_BIT_WEIGHTS, dtype=torch.uint8, device=flat.device)
+    packed = (flat.view(-1, 8) * weights).sum(dim=1, dtype=torch.uint8)
+    return packed.cpu().numpy()
+
+
+def union_mask(masks: Any) -> Tuple[np.ndarray, Tuple[int, int], Dict[str, Any]]:
+    """
+    合并多个 mask 并计算统计信息。
+    masks: (N, H, W) 的 torch.Tensor 或 np.ndarray。
+    Tensor 会在原设备上做 any/sum 归约并打包，只有最终的 bit-packed 结果 (H*W/8 字节) 拷回 CPU。
+    返回: (packed_bits, (H, W), stats)
+    """
+    if isinstance(masks, torch.Tensor):
+        union = masks.bool().any(dim=0)
+        pixel_count = int(union.sum().item())
+        shape = tuple(union.shape)
+        packed = _packbits_tensor(union)
+    else:
+        union = np.logical_or.reduce(np.asarray(masks, dtype=bool), axis=0)
+        pixel_count = int(np.count_nonzero(union))
+        shape = union.shape
+        packed = np.packbits(union)
+
+    total_pixels = shape[0] * shape[1]
+    volume_fraction = (pixel_count / total_pixels) * 100 if total_pixels else 0.0
+
+    stats = {
+        "count": len(masks),
+        "pixel_count": pixel_count,
+        "volume_fraction": round(volume_fraction, 2)
+    }
+    return packed, shape, stats
+
+
+def mask_sanity(mask: np.ndarray) -> Tuple[bool, str, float]:
+    """检查单个 mask 是否可信。返回 (ok, reason, volume_fraction%)"""
+    pixel_count = int(np.count_nonzero(mask))
+    volume_fraction = pixel_count / mask.size * 100 if mask.size else 0.0
+    if pixel_count == 0:
+        return False, "empty", 0.0
+    if volume_fraction < MIN_VOLUME_FRACTION:
+        return False, "too small", volume_fraction
+    if volume_fraction > MAX_VOLUME_FRACTION:
+        return False, "covers whole image", volume_fraction
+    components, _ = cv2.connectedComponents(mask.astype(np.uint8), connectivity=8)
+    if components - 1 > MAX_COMPONENTS:
+        return False, "fragmented", volume_fraction
+    return True, "ok", volume_fraction
+
+
+def is_poor_result(result: Dict[str, Any]) -> bool:
+    """sam3 结果是否需要本地恢复：未找到目标，或合并 mask 面积明显不合理"""
+    if not result.get("success"):
+        return False
+    if not result.get("found"):
+        return True
+    volume_fraction = result.get("stats", {}).get("volume_fraction", 0.0)
+    return not (MIN_VOLUME_FRACTION <= volume_fraction <= MAX_VOLUME_FRACTION)
@@ -27,9 +27,12 @@ class LLMAgent:
         
         **可用工具**:
         1. `sam3`: 图像分割。参数: {"prompts": ["string list"]}。用于识别和分割特定目标（如 "martensite", "black particles"）。
+           - 分割失败或 mask 不合理时，sam3 会自动用材料学同义词 (如 martensite/lath/acicular, carbide/precipitate/particle) 在本地重试，
+             只重试失败的 prompt，其余相保留原结果。"recovered_from" 为 {原 prompt: 替换后的 prompt}，
+             "unrecovered" 为仍失败的 prompt，"alternatives" 为各失败 prompt 的候选排名。
         2. `vlm`: 视觉理解。参数: {"query": "string"}。
            - **强烈建议**: 在进行分割前，先调用此工具询问 "这张图里有哪些主要特征？"，以便为 sam3 提供更准确的 prompt。
-           - 当 sam3 分割失败时，也应调用此工具进行反思和修正。
+           - 仅当 sam3 本地恢复后仍失败 (found: false 或 "unrecovered" 非空) 时，才调用此工具进行反思和修正；可参考 "alternatives" 中得分较高的 prompt。
         3. `finish`: 任务结束。参数: {"response": "给用户的最终回复"}。
         
         **输出格式 (必须是 JSON)**:
@@ -0,0 +1,70 @@
+import os
+import uuid
+import cv2
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+MASK_DIR = "static/masks"
+
+
+class MaskWriter:
+    """
+    后台 mask 编码器：在请求路径之外把 bit-packed 的单通道 mask 编码为 PNG。
+    submit() 立即返回 URL，文件写完前通过 wait() / future() 等待。
+    mask 叠加层的瓦片金字塔不在这里生成，由 /tiles 首次请求时从 PNG 按需构建 (ImageStore.ensure_pyramid)。
+    """
+    def __init__(self, mask_dir: str = MASK_DIR, max_workers: int = 2):
+        self.mask_dir = mask_dir
+        os.makedirs(self.mask_dir, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mask-writer")
+        # filename -> Future (仅保存未完成的写任务)
+        self._pending: Dict[str, Future] = {}
+        self._lock = Lock()
+
+    def submit(self, filename: str, packed: np.ndarray, shape: Tuple[int, int]) -> str:
+        """
+        提交写任务，返回可访问的 URL (文件就绪后才可取到)。
+        文件名按内容寻址，同名文件正在写时直接复用其任务，不重复编码。
+        """
+        with self._lock:
+            future = self._pending.get(filename)
+            submitted = future is None
+            if submitted:
+                future = self.executor.submit(self._write, filename, packed, shape)
+                self._pending[filename] = future
+        # 回调在锁外注册：任务已完成时回调会在当前线程立即执行并再次取锁
+        if submitted:
+            future.add_done_callback(lambda f: self._discard(filename, f))
+        return f"/api/v1/masks/{filename}"
+
+    def future(self, filename: str) -> Optional[Future]:
+        with self._lock:
+            return self._pending.get(filename)
+
+    def wait(self, filename: str, timeout: Optional[float] = None) -> str:
+        """阻塞直到文件写完，返回磁盘路径"""
+        future = self.future(filename)
+        if future is not None:
+            future.result(timeout=timeout)
+        return os.path.join(self.mask_dir, filename)
+
+    def _discard(self, filename: str, future: Future):
+        with self._lock:
+            if self._pending.get(filename) is future:
+                del self._pending[filename]
+
+    def _write(self, filename: str, packed: np.ndarray, shape: Tuple[int, int]):
+        h, w = shape
+        # 单通道 0/255 图，解包后原地乘以 255，避免再分配 H×W×3 的 RGB 图
+        mask_img = np.unpackbits(packed, count=h * w).reshape(h, w)
+        mask_img *= 255
+
+        save_path = os.path.join(self.mask_dir, filename)
+        # 临时文件名唯一，并发写同一文件时互不覆盖/删除对方的临时文件
+        tmp_path = f"{save_path}.{uuid.uuid4().hex}.tmp.png"
+        if not cv2.imwrite(tmp_path, mask_img):
+            raise IOError(f"Mask 编码失败: {save_path}")
+        # 原子替换，防止前端读到写了一半的文件
+        os.replace(tmp_path, save_path)
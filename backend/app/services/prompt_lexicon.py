@@ -0,0 +1,98 @@
+import re
+from itertools import zip_longest
+from typing import Dict, List, Tuple
+
+# 材料显微组织同义词表：同组内的词可互相替换作为 SAM 文本 prompt
+MATERIAL_SYNONYMS: List[List[str]] = [
+    ["martensite", "lath", "acicular", "needle-like", "plate martensite"],
+    ["carbide", "precipitate", "particle", "inclusion", "dispersoid"],
+    ["ferrite", "alpha phase", "equiaxed grain"],
+    ["austenite", "gamma phase", "retained austenite"],
+    ["pearlite", "lamellar colony", "lamellae"],
+    ["bainite", "feathery structure", "sheaf"],
+    ["cementite", "fe3c", "grain boundary film"],
+    ["grain boundary", "boundary", "interface"],
+    ["pore", "void", "porosity", "cavity"],
+    ["crack", "microcrack", "fracture"],
+    ["dendrite", "dendritic arm", "cellular structure"],
+    ["twin", "twin boundary", "annealing twin"],
+]
+
+# 规范化候选：只保留字母、数字与连字符，合并多余空白
+_WORD_RE = re.compile(r"[a-z0-9\-]+")
+
+# 不规则复数 (按最后一个词)
+_IRREGULAR_PLURALS = {"lamella": "lamellae", "lamellae": "lamellae", "fe3c": "fe3c", "matrix": "matrices"}
+
+
+def _plural(term: str) -> str:
+    """词组的复数形式 (只变最后一个词)：boundary -> boundaries, matrix -> matrices"""
+    head, _, last = term.rpartition(" ")
+    if last in _IRREGULAR_PLURALS:
+        last = _IRREGULAR_PLURALS[last]
+    elif last.endswith(("s", "x", "ch", "sh")):
+        last += "es"
+    elif last.endswith("y") and last[-2:-1] not in ("a", "e", "i", "o", "u"):
+        last = last[:-1] + "ies"
+    else:
+        last += "s"
+    return f"{head} {last}" if head else last
+
+
+def _compile_group(group: List[str]) -> Tuple[re.Pattern, Dict[str, Tuple[str, bool]]]:
+    """同组所有词 (含复数) 的匹配模式，较长的词组优先；forms: 命中文本 -> (词, 是否复数)"""
+    forms: Dict[str, Tuple[str, bool]] = {}
+    for term in group:
+        forms.setdefault(_plural(term), (term, True))
+        forms[term] = (term, False)
+    alternatives = sorted(forms, key=len, reverse=True)
+    return re.compile(r"\b(?:" + "|".join(re.escape(a) for a in alternatives) + r")\b"), forms
+
+
+_GROUP_PATTERNS = [_compile_group(group) for group in MATERIAL_SYNONYMS]
+
+
+def _substitutions(prompt: str) -> List[str]:
+    """
+    单个 prompt 的候选：把命中组内的所有词 (单复数均可) 一起替换为同组的另一个词，保留修饰词，
+    并附带裸同义词。已在 prompt 中出现的词不作为替换目标；
+    替换后相邻的重复词合并 ("lath martensite" -> "acicular acicular" -> "acicular")，仍有重复的候选丢弃。
+    """
+    candidates: List[str] = []
+    for group, (pattern, forms) in zip(MATERIAL_SYNONYMS, _GROUP_PATTERNS):
+        matches = pattern.findall(prompt)
+        if not matches:
+            continue
+        hits = {forms[m][0] for m in matches}
+        for term in group:
+            if term in hits:
+                continue
+            plural = _plural(term)
+            candidate = pattern.sub(lambda m: plural if forms[m.group(0)][1] else term, prompt)
+            for form in (plural, term):
+                candidate = re.sub(rf"\b{re.escape(form)}(?:\s+{re.escape(form)}\b)+", form, candidate)
+            if len(re.findall(rf"\b(?:{re.escape(plural)}|{re.escape(term)})\b", candidate)) <= 1:
+                candidates.append(candidate)
+            candidates.append(term)
+    return candidates
+
+
+def expand_prompts(prompts: List[str], max_candidates: int = 16) -> List[str]:
+    """
+    用同义词表扩展失败的 prompts。
+    每个 prompt 生成同组其他词的替换版本 (保留颜色等修饰词) 以及裸同义词；
+    各 prompt 的候选轮流取用，平分 max_candidates 的名额，不会被第一个 prompt 占满。
+    返回去重后的候选列表 (不含原 prompt)。
+    """
+    originals = [p.strip().lower() for p in prompts if p and p.strip()]
+    per_prompt = []
+    for prompt in originals:
+        normalized = (" ".join(_WORD_RE.findall(c)) for c in _substitutions(prompt))
+        per_prompt.append([c for c in dict.fromkeys(normalized) if c and c not in originals])
+
+    candidates: List[str] = []
+    for round_candidates in zip_longest(*per_prompt):
+        for candidate in round_candidates:
+            if candidate is not None and candidate not in candidates:
+                candidates.append(candidate)
+    return candidates[:max_candidates]
@@ -2,7 +2,12 @@ import os
 import cv2
 import numpy as np
 import torch
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
+from app.core.cache import hash_bytes, normalize_params
+from app.core.image_store import ImageStore
+from app.services.analysis import union_mask, mask_sanity, is_poor_result
+from app.services.prompt_lexicon import expand_prompts
+from app.services.mask_writer import MaskWriter
 
 # 假设用户已安装 sam3 库 (基于提供的 notebook)
 try:
@@ -17,7 +22,7 @@ SAM_CHECKPOINT = os.path.join(os.path.dirname(__file__), '..', '..', 'models', '
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 class SAMEngine:
-    def __init__(self):
+    def __init__(self, image_store: Optional[ImageStore] = None):
         print(f"Initializing SAM 3 Engine (Device: {DEVICE})...")
         self.predictor = None
         
@@ -33,26 +38,71 @@ class SAMEngine:
         else:
             print(f"SAM 3 Checkpoint not found at {SAM_CHECKPOINT} or library missing.")
 
+        # 解码后的图像存储 (内存映射)，未提供时回退到 cv2 解码原文件
+        self.image_store = image_store
+
         # 缓存
         self.image_cache: Dict[str, Any] = {} # session_id -> {image_tensor/path}
 
-    def set_image(self, session_id: str, image_path: str):
+        # 后台 PNG 编码，不阻塞请求路径
+        self.mask_writer = MaskWriter()
+
+        # predictor 中当前已编码的图像 (按内容哈希)，相同图片连续使用时不再重新编码
+        self._active_key: Optional[str] = None
+        self._active_shape: Optional[Tuple[int, int]] = None
+
+        # 前向计数 (供 /metrics/sam)：编码次数、decode 前向次数及每次前向处理的 prompt 组数
+        self.encode_count = 0
+        self.forward_count = 0
+        self.forward_items = 0
+        self.max_forward_batch = 0
+
+    def set_image(self, session_id: str, image_path: str, image_hash: Optional[str] = None):
         """预处理图像"""
         if not self.predictor: return
         
+        # 没有内容哈希时退化为按路径区分；编码成功后才登记到 image_cache
+        key = image_hash or image_path
+        shape = self._encode(key, image_path, session_id)
+        self.image_cache[session_id] = {
+            "shape": shape, # H, W
+            "path": image_path,
+            "key": key
+        }
+
+    def _activate(self, session_id: str):
+        """确保 predictor 中是该 Session 的图像 embedding (SAM3 stateful)"""
+        entry = self.image_cache[session_id]
+        entry["shape"] = self._encode(entry["key"], entry["path"], session_id)
+
+    def _encode(self, key: str, image_path: str, session_id: str) -> Tuple[int, int]:
+        """把 key 对应的图像编码进 predictor (已是当前图像则跳过)，返回 (H, W)"""
+        # predictor 没有公开的 embedding 导出/恢复接口，切换图像时只能重新编码
+        if self._active_key == key:
+            return self._active_shape
+
         print(f"SAM 3: Encoding image for session {session_id}...")
-        image = cv2.imread(image_path)
-        if image is None: raise FileNotFoundError(f"Image not found: {image_path}")
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image_rgb = self.load_image(image_path, key)
         
         # SAM 3 的 set_image
+        self._active_key = None
         self.predictor.set_image(image_rgb)
-        
-        # 缓存原始尺寸等信息
-        self.image_cache[session_id] = {
-            "shape": image_rgb.shape[:2], # H, W
-            "path": image_path
-        }
+        self.encode_count += 1
+        self._active_key, self._active_shape = key, image_rgb.shape[:2]
+        return self._active_shape
+
+    def load_image(self, image_path: str, image_hash: Optional[str] = None) -> np.ndarray:
+        """取 RGB 图像：优先使用 ImageStore 中的内存映射，否则解码原文件"""
+        if self.image_store is not None and self.image_store.has(image_hash):
+            return self.image_store.get(image_hash)
+        image = cv2.imread(image_path)
+        if image is None: raise FileNotFoundError(f"Image not found: {image_path}")
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    def image_key(self, session_id: str) -> Optional[str]:
+        """Session 对应的图像键 (内容哈希)，未编码返回 None"""
+        entry = self.image_cache.get(session_id)
+        return entry["key"] if entry else None
 
     def predict_by_text(self, session_id: str, prompts: List[str]) -> Dict[str, Any]:
         """
@@ -62,62 +112,186 @@ class SAMEngine:
             return {"success": False, "message": "SAM 3 Model not loaded."}
         
         # 1. 确保当前 Predictor 加载的是该 Session 的图 (SAM3 stateful)
-        # 简化处理：实际生产中可能需要管理多个 predictor 或重新 set_image
-        if session_id in self.image_cache:
-            # 重新加载图片以确保上下文正确 (根据 sam3 实现可能不需要每次都做，但为了安全)
-            path = self.image_cache[session_id]["path"]
-            image = cv2.imread(path)
-            image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            self.predictor.set_image(image_rgb)
-        else:
+        # predictor 中已是同一图像 (按内容哈希) 时直接复用，不再重新编码
+        if session_id not in self.image_cache:
             return {"success": False, "message": "Session image not encoded."}
 
         try:
+            self._activate(session_id)
             print(f"SAM 3 Predicting with prompts: {prompts}")
             
             # 2. 调用 SAM 3 预测 (参考 Notebook API)
-            # predict 返回: masks, scores, logits
-            masks, scores, _ = self.predictor.predict(
-                prompts=prompts,
-                box_prompts=None, # 我们优先用文本
-                point_prompts=None
-            )
-            
-            # 3. 后处理结果
-            # masks shape usually: (N_prompts, H, W) or similar
-            if len(masks) == 0:
-                return {"success": True, "found": False, "message": "No objects found."}
+            masks, scores = self._forward(prompts=prompts)
+            return self._build_result(session_id, prompts, masks)
+        except Exception as e:
+            print(f"SAM 3 Prediction Error: {e}")
+            return {"success": False, "message": str(e)}
 
-            # 合并所有 mask 用于展示
-            final_mask = np.any(masks, axis=0) # Logical OR
-            
-            # 计算统计信息 (简单版)
-            pixel_count = np.sum(final_mask)
-            total_pixels = final_mask.size
-            volume_fraction = (pixel_count / total_pixels) * 100
-            
-            # 保存掩码文件
-            mask_img = np.zeros((*final_mask.shape, 3), dtype=np.uint8)
-            mask_img[final_mask] = [255, 255, 255]
-            
-            filename = f"sam3_mask_{session_id}_{int(volume_fraction)}.png"
-            save_path = os.path.join("static/masks", filename)
-            cv2.imwrite(save_path, mask_img)
-            
-            return {
-                "success": True,
-                "found": True,
-                "mask_url": f"/static/masks/{filename}",
-                "stats": {
-                    "targets": prompts,
-                    "count": len(masks), # 或者是连通域数量
-                    "volume_fraction": round(volume_fraction, 2)
-                }
+    def _forward(self, prompts: Optional[List[str]] = None, boxes: Optional[List[List[int]]] = None):
+        """
+        predictor 的一次 decode 前向 (一组 prompt)，返回原始 (masks, scores)。
+        predictor 没有多组 prompt 的批量接口，每次前向的批大小恒为 1，仍如实计数。
+        """
+        # predict 返回: masks, scores, logits
+        masks, scores, _ = self.predictor.predict(
+            prompts=prompts,
+            box_prompts=boxes,
+            point_prompts=None
+        )
+        self.forward_count += 1
+        self.forward_items += 1
+        self.max_forward_batch = max(self.max_forward_batch, 1)
+        return masks, scores
+
+    def _build_result(self, session_id: str, prompts: List[str], masks: Any, recovered: bool = False) -> Dict[str, Any]:
+        # 3. 后处理结果
+        # masks shape usually: (N_prompts, H, W) or similar
+        if len(masks) == 0:
+            return {"success": True, "found": False, "message": "No objects found."}
+
+        # 合并所有 mask 用于展示 (在 Tensor 所在设备上归约，只拷回 bit-packed 结果)
+        packed, shape, mask_stats = union_mask(masks)
+        volume_fraction = mask_stats["volume_fraction"]
+
+        # 保存掩码文件 (后台编码，URL 在文件写完后可取)
+        # 文件名按 (图像, 规范化 prompts) 内容寻址，缓存中的 mask_url 不会被其他预测覆盖
+        filename = self._mask_filename(session_id, prompts, recovered)
+        mask_url = self.mask_writer.submit(filename, packed, shape)
+        
+        return {
+            "success": True,
+            "found": True,
+            "mask_url": mask_url,
+            "stats": {
+                "targets": prompts,
+                "count": mask_stats["count"], # 或者是连通域数量
+                "volume_fraction": volume_fraction
             }
+        }
+
+    def _mask_filename(self, session_id: str, prompts: List[str], recovered: bool = False) -> str:
+        # 恢复结果由逐 prompt decode 合并而来，与同一组 prompts 的单次 decode 内容不同，单独命名
+        params = {"prompts": prompts, "recovered": True} if recovered else {"prompts": prompts}
+        image_id = hash_bytes(self.image_cache[session_id]["key"].encode())[:16]
+        params_id = hash_bytes(normalize_params("sam3", params).encode())[:16]
+        return f"sam3_mask_{image_id}_{params_id}.png"
 
+    def predict_with_recovery(self, session_id: str, prompts: List[str], max_candidates: int = 8,
+                              max_alternatives: int = 5) -> Dict[str, Any]:
+        """
+        文本分割 + 本地恢复，整体作为一次调度调用执行 (首次 decode 与恢复之间 predictor 不会被其他会话切换)。
+        合并结果不合理 (未找到 / 面积异常) 时逐个 prompt decode 找出失败的相，
+        只对失败的 prompt 用材料同义词表扫描恢复，其余相保留原 mask，无需远程 LLM/VLM 调用。
+        """
+        result = self.predict_by_text(session_id, prompts)
+        if not is_poor_result(result):
+            return result
+
+        print(f"SAM 3 result poor, recovering failed prompts: {prompts}")
+        try:
+            recovery = self._recover_prompts(session_id, prompts, max_candidates, max_alternatives)
         except Exception as e:
-            print(f"SAM 3 Prediction Error: {e}")
-            return {"success": False, "message": str(e)}
+            print(f"SAM 3 Prompt Sweep Error: {e}")
+            return result
+
+        if not recovery.get("found"):
+            # 恢复失败时保留原结果 (可能仍有 mask)，附上候选排名供 LLM 参考
+            result["recovered"] = False
+            result["alternatives"] = recovery["alternatives"]
+            return result
+        return recovery
+
+    def _recover_prompts(self, session_id: str, prompts: List[str], max_candidates: int,
+                         max_alternatives: int) -> Dict[str, Any]:
+        """逐个 prompt 检查并恢复失败的相，合并成功相与恢复相的实例 mask"""
+        self._activate(session_id)
+
+        kept_masks, targets = [], []
+        recovered_from: Dict[str, str] = {}
+        alternatives: Dict[str, List[Dict[str, Any]]] = {}
+        unrecovered: List[str] = []
+        for prompt in prompts:
+            # 单个 prompt 时合并结果即为该 prompt 的结果，无需再 decode
+            if len(prompts) > 1:
+                masks, _ = self.decode(prompts=[prompt])
+                if len(masks) and mask_sanity(np.logical_or.reduce(masks, axis=0))[0]:
+                    kept_masks.append(masks)
+                    targets.append(prompt)
+                    continue
+
+            best, ranked = self._sweep_prompt(prompt, max_candidates)
+            alternatives[prompt] = ranked[:max_alternatives]
+            if best is None:
+                unrecovered.append(prompt)
+                continue
+            _, best_prompt, best_masks = best
+            kept_masks.append(best_masks)
+            targets.append(best_prompt)
+            recovered_from[prompt] = best_prompt
+            print(f"SAM 3 Recovered '{prompt}' with '{best_prompt}'")
+
+        if not recovered_from:
+            return {"success": True, "found": False, "recovered": False, "alternatives": alternatives,
+                    "message": "No synonym candidate produced a plausible mask."}
+
+        result = self._build_result(session_id, targets, np.concatenate(kept_masks), recovered=True)
+        result["recovered"] = True
+        result["recovered_from"] = recovered_from  # 原 prompt -> 替换后的 prompt
+        result["unrecovered"] = unrecovered        # 扫描后仍失败的 prompt (已从结果中略去)
+        result["alternatives"] = alternatives
+        return result
+
+    def _sweep_prompt(self, prompt: str, max_candidates: int):
+        """
+        单个失败 prompt 的同义词扫描：每个候选在当前 embedding 上单独 decode
+        (实例 mask 不带 prompt 标签，只有逐个 decode 才能确定归属)，按模型得分 + mask 合理性排序。
+        返回 (best, ranked)，best 为 (score, prompt, masks) 或 None。
+        """
+        candidates = expand_prompts([prompt], max_candidates=max_candidates)
+        print(f"SAM 3 Prompt sweep: {prompt} -> {candidates}")
+
+        ranked, best = [], None
+        for candidate in candidates:
+            masks, scores = self.decode(prompts=[candidate])
+            if len(masks):
+                ok, reason, volume_fraction = mask_sanity(np.logical_or.reduce(masks, axis=0))
+            else:
+                ok, reason, volume_fraction = False, "empty", 0.0
+            model_score = float(scores.max()) if scores.size else 0.0
+            score = model_score if ok else 0.0
+
+            # 只保留当前最佳候选的实例 mask，避免同时持有所有候选的全分辨率 mask
+            if ok and (best is None or score > best[0]):
+                best = (score, candidate, masks)
+            ranked.append({
+                "prompt": candidate,
+                "score": round(score, 4),
+                "model_score": round(model_score, 4),
+                "volume_fraction": round(volume_fraction, 2),
+                "check": reason
+            })
+
+        ranked.sort(key=lambda r: r["score"], reverse=True)
+        return best, ranked
+
+    def encode_frame(self, image_rgb: np.ndarray):
+        """编码单帧 (序列分析使用，不登记到会话缓存)；之后可多次 decode() 复用同一 embedding"""
+        # predictor 中将不再是任何会话的图像
+        self._active_key = None
+        self.predictor.set_image(image_rgb)
+        self.encode_count += 1
+
+    def decode(self, prompts: Optional[List[str]] = None, boxes: Optional[List[List[int]]] = None):
+        """
+        在当前已编码的图像上 decode 一次。
+        prompts 与 boxes 二选一；返回 (masks[N, H, W] bool, scores[N])，均为 numpy。
+        """
+        masks, scores = self._forward(prompts=prompts, boxes=boxes)
+        if isinstance(masks, torch.Tensor):
+            masks = masks.cpu().numpy()
+        if isinstance(scores, torch.Tensor):
+            scores = scores.float().cpu().numpy()
+        return np.asarray(masks, dtype=bool), np.asarray(scores, dtype=np.float32)
 
     # 保留点击预测用于 HITL
     def predict_click(self, session_id: str, points: List[Dict]) -> Dict[str, Any]:
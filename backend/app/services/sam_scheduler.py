@@ -0,0 +1,115 @@
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+from typing import Any, Callable, Dict, List
+from app.services.sam_engine import SAMEngine
+
+
+class _Request:
+    __slots__ = ("fn", "args", "kwargs", "future", "enqueued")
+
+    def __init__(self, fn: Callable, args: tuple, kwargs: dict, future: Future):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.enqueued = time.perf_counter()
+
+
+class SAMScheduler:
+    """
+    位于 SAMEngine 前的串行执行器：predictor 是有状态的，所有访问都由单个后台线程按到达顺序逐个执行，
+    结果通过 Future 回传给各调用方 (async 端点 await 时不阻塞事件循环)。
+    不做跨请求合批：predictor 没有一次前向处理多组 prompt 并按请求拆分输出的接口，
+    因此不设等待窗口，请求到达即执行；同一图像的连续请求由 SAMEngine 跳过重复编码。
+    """
+    def __init__(self, sam_engine: SAMEngine):
+        self.sam_engine = sam_engine
+
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._lock = threading.Lock()
+        # 指标
+        self._requests = 0
+        self._recent_delays_ms: deque = deque(maxlen=1000)
+
+        self._worker = threading.Thread(target=self._run, name="sam-scheduler", daemon=True)
+        self._worker.start()
+
+    # --- 提交接口 ---
+
+    def submit_text(self, session_id: str, prompts: List[str]) -> Future:
+        """提交文本分割请求，返回 Future[result dict] (与 SAMEngine.predict_by_text 相同)"""
+        return self.submit_call(self.sam_engine.predict_by_text, session_id, list(prompts))
+
+    def submit_call(self, fn: Callable, *args, **kwargs) -> Future:
+        """在调度线程上独占执行任意 predictor 操作 (set_image、序列帧分析等)"""
+        future = Future()
+        self._queue.put(_Request(fn, args, kwargs, future))
+        return future
+
+    def predict_by_text(self, session_id: str, prompts: List[str]) -> Dict[str, Any]:
+        """同步版本，供非 async 调用方使用"""
+        return self.submit_text(session_id, prompts).result()
+
+    def call(self, fn: Callable, *args, **kwargs) -> Any:
+        return self.submit_call(fn, *args, **kwargs).result()
+
+    # --- 调度线程 ---
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            # 已被取消的请求 (如 await 方断开) 直接跳过；进入 RUNNING 后 Future 不可再被取消
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            try:
+                result = request.fn(*request.args, **request.kwargs)
+            except Exception as e:
+                # 异常交给调用方，调度线程不能退出，否则之后所有 SAM 请求都会挂起
+                self._fail(request, e)
+            else:
+                request.future.set_result(result)
+
+            with self._lock:
+                self._requests += 1
+                self._recent_delays_ms.append((started - request.enqueued) * 1000)
+
+    @staticmethod
+    def _fail(request: _Request, error: Exception):
+        """尽力把异常交给调用方；Future 已完成/已取消时忽略"""
+        if not request.future.done():
+            try:
+                request.future.set_exception(error)
+            except InvalidStateError:
+                pass
+
+    # --- 指标 ---
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            delays = sorted(self._recent_delays_ms)
+            requests = self._requests
+
+        def percentile(values: List[float], q: float) -> float:
+            return round(values[min(len(values) - 1, int(q * len(values)))], 3) if values else 0.0
+
+        engine = self.sam_engine
+        return {
+            "queue_depth": self._queue.qsize(),
+            "requests": requests,
+            "encodes": engine.encode_count,
+            # 每次 predictor 前向实际处理的 prompt 组数 (当前 predictor 每次前向只处理一组)
+            "forward_passes": engine.forward_count,
+            "avg_forward_batch_size": round(engine.forward_items / engine.forward_count, 3)
+            if engine.forward_count else 0.0,
+            "max_forward_batch_size": engine.max_forward_batch,
+            # 排队等待前面请求执行完的时间 (无合批等待窗口)
+            "queue_delay_ms": {
+                "p50": percentile(delays, 0.5),
+                "p95": percentile(delays, 0.95),
+                "max": round(delays[-1], 3) if delays else 0.0
+            }
+        }
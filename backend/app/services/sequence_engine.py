@@ -0,0 +1,165 @@
+import cv2
+import numpy as np
+from typing import List, Dict, Any, Iterator, Optional
+from app.services.sam_engine import SAMEngine
+from app.services.sam_scheduler import SAMScheduler
+
+
+class SequenceSession:
+    """
+    原位/连续帧序列 (同一视场的加热、变形过程)。
+    第一帧用文本 prompt 全量分割 (每个相一个 prompt)，之后用上一帧的 mask 生成 box prompt 逐帧传播，
+    只有检测到漂移或框外出现新区域时才改用文本分割结果，无需每帧走一遍 LLM 规划循环。
+    """
+    def __init__(self, session_id: str, frame_paths: List[str], frame_hashes: Optional[List[str]] = None):
+        self.session_id = session_id
+        self.frame_paths = frame_paths
+        # 帧内容哈希，用于从 ImageStore 读取已解码的帧
+        self.frame_hashes = frame_hashes or [None] * len(frame_paths)
+        # 最近一次分析的逐帧结果 (时间序列)
+        self.results: List[Dict[str, Any]] = []
+
+
+class SequenceEngine:
+    def __init__(self, sam_engine: SAMEngine, scheduler: SAMScheduler,
+                 drift_iou: float = 0.6,
+                 min_score: float = 0.5,
+                 reseg_interval: int = 50,
+                 region_check_interval: int = 5,
+                 new_region_fraction: float = 0.5,
+                 max_boxes_per_phase: int = 32,
+                 min_component_area: int = 16):
+        self.sam_engine = sam_engine
+        self.scheduler = scheduler                      # 帧推理与其他会话共用同一调度线程
+        self.drift_iou = drift_iou                      # 与上一帧 IoU 低于此值视为漂移
+        self.min_score = min_score                      # 传播平均得分低于此值视为漂移
+        self.reseg_interval = reseg_interval            # 每隔 N 帧强制重新文本分割 (0 = 不强制)
+        self.region_check_interval = region_check_interval  # 每隔 N 帧在已编码的帧上做一次文本 decode，检查框外新区域 (0 = 不检查)
+        self.new_region_fraction = new_region_fraction  # 某相在上一帧框外的面积占比 (%) 超过此值视为出现新区域
+        self.max_boxes_per_phase = max_boxes_per_phase  # 每个相最多传播的连通域数
+        self.min_component_area = min_component_area    # 忽略过小的连通域 (噪点)
+
+    def analyze(self, sequence: SequenceSession, prompts: List[str]) -> Iterator[Dict[str, Any]]:
+        """逐帧分析，每完成一帧 yield 一条结果 (用于流式返回时间序列)"""
+        if not self.sam_engine.predictor:
+            yield {"success": False, "message": "SAM 3 Model not loaded."}
+            return
+
+        sequence.results = []
+        prev_phases: Optional[List[np.ndarray]] = None
+        frames_since_reseg = 0
+
+        for index, (path, image_hash) in enumerate(zip(sequence.frame_paths, sequence.frame_hashes)):
+            try:
+                image_rgb = self.sam_engine.load_image(path, image_hash)
+                force_reseg = self.reseg_interval and frames_since_reseg >= self.reseg_interval
+                check_regions = bool(self.region_check_interval) and \
+                    (frames_since_reseg + 1) % self.region_check_interval == 0
+                # 整帧在调度线程上一次执行，保证编码与 decode 之间 predictor 不被其他会话切换
+                phases, mode, iou = self.scheduler.call(
+                    self._analyze_frame, image_rgb, prompts, None if force_reseg else prev_phases, check_regions
+                )
+                frames_since_reseg = frames_since_reseg + 1 if mode == "propagate" else 0
+            except Exception as e:
+                print(f"Sequence Frame {index} Error: {e}")
+                record = {"success": False, "frame": index, "message": str(e)}
+                sequence.results.append(record)
+                yield record
+                continue
+
+            total_pixels = image_rgb.shape[0] * image_rgb.shape[1]
+            fractions = {
+                prompt: round(int(np.count_nonzero(mask)) / total_pixels * 100, 2)
+                for prompt, mask in zip(prompts, phases)
+            }
+            record = {
+                "success": True,
+                "frame": index,
+                "mode": mode,
+                "iou_prev": None if iou is None else round(iou, 3),
+                "phase_fractions": fractions
+            }
+            sequence.results.append(record)
+            yield record
+            prev_phases = phases
+
+    def _analyze_frame(self, image_rgb: np.ndarray, prompts: List[str], prev_phases: Optional[List[np.ndarray]],
+                       check_regions: bool = False):
+        """
+        每帧只编码一次：传播、框外新区域检查与 (漂移时的) 重新文本分割共用同一 embedding。
+        box 传播只能跟踪已有区域，在框外形核/长大的区域由定期的文本 decode 发现。
+        返回 (phases, mode, iou)。
+        """
+        self.sam_engine.encode_frame(image_rgb)
+        shape = image_rgb.shape[:2]
+
+        iou = None
+        if prev_phases is not None:
+            phases, iou, regions = self._propagate(shape, prev_phases)
+            if phases is not None:
+                if not check_regions:
+                    return phases, "propagate", iou
+                segmented = self._segment(shape, prompts)
+                if not self._has_new_regions(segmented, regions):
+                    return phases, "propagate", iou
+                return segmented, "segment", iou
+
+        # 首帧 / 漂移 / 定期校正：重新文本分割
+        return self._segment(shape, prompts), "segment", iou
+
+    def _segment(self, shape, prompts: List[str]) -> List[np.ndarray]:
+        """每个相单独 decode 一次，合并该相的所有实例 mask"""
+        phases = []
+        for prompt in prompts:
+            masks, _ = self.sam_engine.decode(prompts=[prompt])
+            phases.append(np.logical_or.reduce(masks, axis=0) if len(masks) else np.zeros(shape, dtype=bool))
+        return phases
+
+    def _propagate(self, shape, prev_phases: List[np.ndarray]):
+        """
+        用上一帧各相连通域的外接框作为 box prompt，每个相 decode 一次并合并其实例 mask。
+        返回 (phases, iou, regions)，regions 为各相 box 覆盖的区域；检测到漂移时 phases 为 None。
+        """
+        phases, regions, all_scores = [], [], []
+        for mask in prev_phases:
+            boxes = self._mask_to_boxes(mask)
+            region = np.zeros(shape, dtype=bool)
+            for x0, y0, x1, y1 in boxes:
+                region[y0:y1, x0:x1] = True
+            regions.append(region)
+            if not boxes:
+                phases.append(np.zeros(shape, dtype=bool))
+                continue
+            masks, scores = self.sam_engine.decode(boxes=boxes)
+            all_scores.extend(np.ravel(scores).tolist())
+            phases.append(np.logical_or.reduce(masks, axis=0) if len(masks) else np.zeros(shape, dtype=bool))
+
+        if not all_scores or float(np.mean(all_scores)) < self.min_score:
+            return None, None, regions
+
+        prev_union = np.logical_or.reduce(prev_phases)
+        union = np.logical_or.reduce(phases)
+        denom = np.count_nonzero(prev_union | union)
+        iou = np.count_nonzero(prev_union & union) / denom if denom else 1.0
+        if iou < self.drift_iou:
+            return None, iou, regions
+        return phases, iou, regions
+
+    def _has_new_regions(self, segmented: List[np.ndarray], regions: List[np.ndarray]) -> bool:
+        """文本分割结果中是否有相在上一帧 box 之外出现了足够大的新区域"""
+        for mask, region in zip(segmented, regions):
+            outside = np.count_nonzero(mask & ~region)
+            if outside / mask.size * 100 >= self.new_region_fraction:
+                return True
+        return False
+
+    def _mask_to_boxes(self, mask: np.ndarray) -> List[List[int]]:
+        """取面积最大的若干连通域，返回 [x0, y0, x1, y1] 列表"""
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+        # 第 0 个是背景
+        components = [s for s in stats[1:count] if s[cv2.CC_STAT_AREA] >= self.min_component_area]
+        components.sort(key=lambda s: s[cv2.CC_STAT_AREA], reverse=True)
+        return [
+            [int(x), int(y), int(x + w), int(y + h)]
+            for x, y, w, h, _ in components[:self.max_boxes_per_phase]
+        ]
@@ -1,7 +1,8 @@
 import os
 import base64
 from io import BytesIO
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+import numpy as np
 from openai import OpenAI
 from PIL import Image
 
@@ -18,25 +19,27 @@ class VLMAgent:
         self.client = OpenAI(api_key=self.api_key, base_url=QWEN_BASE_URL)
         self.vlm_model = "qwen-vl-max"
 
-    def _local_image_to_base64(self, image_path: str) -> str:
+    def _local_image_to_base64(self, image_path: str, image: Optional[np.ndarray] = None) -> str:
         try:
-            img = Image.open(image_path).convert("RGB")
+            # 已解码的 RGB 数组 (ImageStore 内存映射) 优先，避免再次解码原文件
+            img = Image.fromarray(np.asarray(image)) if image is not None else Image.open(image_path).convert("RGB")
             buffer = BytesIO()
             img.save(buffer, format="JPEG")
             return base64.b64encode(buffer.getvalue()).decode('utf-8')
         except Exception as e:
             raise Exception(f"图片处理失败: {e}")
 
-    def answer_visual_question(self, image_path: str, question: str) -> Dict[str, Any]:
+    def answer_visual_question(self, image_path: str, question: str, image: Optional[np.ndarray] = None) -> Dict[str, Any]:
         """
         视觉问答 (VQA) 接口。
         question: 由 Agent 1 生成的针对图片的具体问题。
+        image: (可选) 已解码的 RGB 数组。
         """
         if not self.client:
             return {"success": False, "message": "VLM 客户端未初始化"}
         
         try:
-            base64_image = self._local_image_to_base64(image_path)
+            base64_image = self._local_image_to_base64(image_path, image)
             
             messages = [
                 {